@@ -9,6 +9,7 @@ sudo podman run -it --rm \
     --gpus all -v /dev/dri:/dev/dri \
     -v $PWD:/host \
     -m 15g \
+    --shm-size 1g \
     --cpus 0.9 \
     -v $HOME/projects/media2x/video2x:/video2x \
     -e PYTHONPATH=/video2x \
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from video2x import frame_difference
+
+
+def test_numba_matches_numpy():
+    if frame_difference.ENABLE_NUMBA is False:
+        pytest.skip("Numba is not installed")
+
+    random = np.random.default_rng(0)
+    for shape in [(4, 64, 64, 3), (3, 64, 64, 1), (1, 1, 1, 3)]:
+        images0 = random.integers(0, 256, shape, dtype=np.uint8)
+        images1 = random.integers(0, 256, shape, dtype=np.uint8)
+        np.testing.assert_allclose(
+            frame_difference._get_difference_ratios_numba(images0, images1),
+            frame_difference._get_difference_ratios_numpy(images0, images1),
+        )
+
+
+def test_identical_frames():
+    images = np.full((2, 64, 64, 3), 127, np.uint8)
+    assert not frame_difference.get_difference_ratios(images, images).any()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import queue
+
+import cv2
+import numpy as np
+import pytest
+
+from video2x.frame_ring import (
+    BUFFER_ALIGNMENT,
+    INPUT,
+    OUTPUT,
+    FrameRing,
+    ProcessedFrames,
+)
+
+
+@pytest.fixture
+def frame_ring():
+    frame_ring = FrameRing(2, 63, 47, 126, 94)
+    yield frame_ring
+    frame_ring.close()
+
+
+def test_buffer_slot_round_trip():
+    for slot in range(8):
+        for kind in [INPUT, OUTPUT]:
+            buffer = FrameRing.buffer(slot, kind)
+            assert FrameRing.slot(buffer) == slot
+            assert buffer % 2 == kind
+
+
+def test_output_offset_alignment(frame_ring):
+    assert frame_ring.output_offset % BUFFER_ALIGNMENT == 0
+    assert frame_ring.output_offset >= frame_ring.input_size
+
+    input_frame = frame_ring.array(FrameRing.buffer(1, INPUT))
+    output_frame = frame_ring.array(FrameRing.buffer(1, OUTPUT))
+    assert input_frame.shape == (47, 63, 3)
+    assert output_frame.shape == (94, 126, 3)
+
+    # writing the input frame must not touch the output frame
+    output_frame[...] = 0
+    input_frame[...] = 255
+    assert not output_frame.any()
+
+
+def test_acquire_retain_release(frame_ring):
+    slot = frame_ring.acquire(2, timeout=1)
+    frame_ring.retain(slot)
+
+    # the slot only becomes free again once all references are released
+    frame_ring.release(slot, 2)
+    other_slot = frame_ring.acquire(1, timeout=1)
+    assert other_slot != slot
+    with pytest.raises(queue.Empty):
+        frame_ring.acquire(1, timeout=0.1)
+
+    frame_ring.release(slot)
+    assert frame_ring.acquire(1, timeout=1) == slot
+
+
+def test_processed_frames_wait():
+    processed_frames = ProcessedFrames(2)
+    assert processed_frames.wait(1, timeout=0.1) == -1
+
+    processed_frames.publish(1, 3)
+    assert processed_frames.wait(1, timeout=0.1) == 3
+    assert processed_frames.wait(0, timeout=0.1) == -1
+
+
+def test_stop():
+    frame_ring = FrameRing(1, 2, 2, 4, 4)
+    try:
+        assert frame_ring.acquire(1, timeout=1) == 0
+        frame_ring.stop()
+        assert frame_ring.acquire(1, timeout=1) is None
+    finally:
+        frame_ring.close()
+
+    processed_frames = ProcessedFrames(1)
+    processed_frames.stop()
+    assert processed_frames.wait(0) == -1
+
+
+def test_nv12_to_rgb():
+    random = np.random.default_rng(0)
+    frame = np.empty((72, 64), np.uint8)
+    frame[:48] = random.integers(16, 236, (48, 64))
+
+    # with constant chroma, interpolating and repeating the chroma match
+    frame[48:] = np.tile(np.array([90, 200], np.uint8), (24, 32))
+    np.testing.assert_allclose(
+        FrameRing.nv12_to_rgb(frame),
+        cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_NV12),
+        atol=1,
+    )
+
+    # limited range black and white
+    frame[:48], frame[48:] = 16, 128
+    assert not FrameRing.nv12_to_rgb(frame).any()
+    frame[:48] = 235
+    assert (FrameRing.nv12_to_rgb(frame, (16, 16), cv2.INTER_AREA) == 255).all()
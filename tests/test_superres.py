@@ -1,26 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+
 import cv2
-import matplotlib.pyplot as plt
-from .superres import SuperRes
-
-class SuperRes:
-    def __init__(self) -> int:
-        self.version = 1.0
-    
-    def run(model: str) -> None:
-        img = cv2.imread(model)
-        
-        sr = cv2.dnn_superres.DnnSuperResImpl_create()
-        sr.readModel("video2x/models/LapSRN_x8.pb")
-        sr.setModel("lapsrn", 8)
-        sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-        
-        result = sr.upsample(img)
-        return result
-
-def test_opencv_superres():
-    model = "data/test_image.png"
-    img = cv2.imread(model)
-    dims = img.shape[1]
-    sr = SuperRes()
-    assert sr.run(model) ==  dims * 8
+import numpy as np
+import pytest
+import utils
+
+from video2x.superres import EDSR_MEAN, SuperRes
+
+MODELS = ["edsr", "espcn", "fsrcnn", "lapsrn"]
+
+
+@pytest.fixture
+def models_path(tmp_path, monkeypatch):
+    """
+    write small x2 models where SuperRes loads its models from
+    """
+    models_path = tmp_path / "video2x" / "models"
+    models_path.mkdir(parents=True)
+    for model in MODELS:
+        utils.write_superres_model(
+            models_path / f"{model}_x2.pb", 3 if model == "edsr" else 1, 2
+        )
+    monkeypatch.chdir(tmp_path)
+    return models_path
+
+
+@pytest.fixture
+def images():
+    # a small crop keeps the test fast on the CPU
+    image = cv2.imread(str(Path(__file__).parent / "data" / "test_image.png"))
+    image = image[:64, :96]
+    return [np.ascontiguousarray(i) for i in [image, image[::-1], image[:, ::-1]]]
+
+
+def upsample(net: cv2.dnn.Net, model: str, image: np.ndarray) -> np.ndarray:
+    """
+    upscale a BGR frame the way dnn_superres's DnnSuperResImpl.upsample does
+    """
+    if model == "edsr":
+        net.setInput(
+            cv2.dnn.blobFromImage(image.astype(np.float32), 1.0, mean=EDSR_MEAN)
+        )
+        output = net.forward()[0].transpose(1, 2, 0) + EDSR_MEAN
+        return np.clip(np.rint(output), 0, 255).astype(np.uint8)
+
+    # Mat::convertTo scales 8-bit values by a single precision factor
+    ycrcb_image = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb).astype(np.float32)
+    ycrcb_image *= np.float32(1 / 255)
+    net.setInput(cv2.dnn.blobFromImage(ycrcb_image[..., 0]))
+    output = net.forward()[0, 0]
+    merged = cv2.merge(
+        [output]
+        + [cv2.resize(ycrcb_image[..., c], None, fx=2, fy=2) for c in [1, 2]]
+    )
+    merged = np.clip(np.rint(merged * 255), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(merged, cv2.COLOR_YCrCb2BGR)
+
+
+def assert_images_match(results: list, references: list) -> None:
+    assert len(results) == len(references)
+    for result, reference in zip(results, references):
+        assert result.shape == reference.shape
+        difference = np.abs(result.astype(np.int16) - reference)
+        assert difference.max() <= 1
+        assert np.count_nonzero(difference) <= difference.size * 0.001
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_process_batch(model, models_path, images):
+    net = cv2.dnn.readNetFromTensorflow(str(models_path / f"{model}_x2.pb"))
+    references = [upsample(net, model, i)[..., ::-1] for i in images]
+
+    # run a full batch and then a smaller batch to reuse the input blob
+    superres = SuperRes(gpuid=-1, scale=2, model=model)
+    for batch_size in [3, 1]:
+        results = superres.process_batch(
+            [np.ascontiguousarray(i[..., ::-1]) for i in images[:batch_size]]
+        )
+        assert_images_match(results, references[:batch_size])
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_process_batch_matches_dnn_superres(model, models_path, images):
+    if not hasattr(cv2, "dnn_superres"):
+        pytest.skip("OpenCV was built without the contrib modules")
+
+    reference = cv2.dnn_superres.DnnSuperResImpl_create()
+    reference.readModel(str(models_path / f"{model}_x2.pb"))
+    reference.setModel(model, 2)
+
+    superres = SuperRes(gpuid=-1, scale=2, model=model)
+    assert_images_match(
+        superres.process_batch([np.ascontiguousarray(i[..., ::-1]) for i in images]),
+        [reference.upsample(i)[..., ::-1] for i in images],
+    )
@@ -4,12 +4,16 @@
 import ctypes
 import multiprocessing
 import os
+import queue
 from pathlib import Path
 
+import numpy as np
 import utils
 from PIL import Image
 
 from video2x import Upscaler, Video2X
+from video2x import upscaler
+from video2x.frame_ring import INPUT, OUTPUT, FrameRing, ProcessedFrames
 
 
 def test_upscaling():
@@ -53,3 +57,76 @@ def test_get_scaling_tasks():
         ("realcugan", [3, 4]),
     ]:
         assert Upscaler._get_scaling_tasks(*dimensions, algorithm) == correct_answer
+
+
+class StubProcessor:
+    """
+    upscales frames by repeating pixels and records the batches it gets
+    """
+
+    batches = []
+
+    def __init__(self, scale: int, **kwargs) -> None:
+        self.scale = scale
+
+    def process_batch(self, images: list) -> list:
+        StubProcessor.batches.append([i.copy() for i in images])
+        return [
+            np.repeat(np.repeat(i, self.scale, axis=0), self.scale, axis=1)
+            for i in images
+        ]
+
+
+def test_upscaler_run(monkeypatch):
+    monkeypatch.setitem(upscaler.ALGORITHM_CLASSES, "stub", StubProcessor)
+    monkeypatch.setitem(upscaler.ALGORITHM_FIXED_SCALING_RATIOS, "stub", [2])
+    StubProcessor.batches = []
+
+    # frame 2 repeats frame 1 and is skipped
+    random = np.random.default_rng(0)
+    frames = [random.integers(0, 256, (32, 48, 3), dtype=np.uint8) for _ in range(4)]
+    frames[2] = frames[1].copy()
+
+    frame_ring = FrameRing(len(frames), 48, 32, 96, 64)
+    processed_frames = ProcessedFrames(len(frames))
+    try:
+        # queue the frames the way the decoder does
+        # a plain queue makes all of them available to the first batch
+        processing_queue = queue.Queue()
+        previous_slot = None
+        for frame_index, frame in enumerate(frames):
+            slot = frame_ring.acquire(2)
+            frame_ring.array(FrameRing.buffer(slot, INPUT))[...] = frame
+            processing_queue.put(
+                (frame_index, (previous_slot, slot), (96, 64, 3, 1, "stub"))
+            )
+            previous_slot = slot
+        processing_queue.put(None)
+
+        Upscaler(
+            0,
+            processing_queue,
+            frame_ring,
+            processed_frames,
+            multiprocessing.Value(ctypes.c_bool, False),
+            processed_frames.stop_event,
+            num_gpus=0,
+            num_threads=1,
+        ).run()
+
+        # the changed frames are processed in one batch
+        assert len(StubProcessor.batches) == 1
+        assert len(StubProcessor.batches[0]) == 3
+        for image, frame_index in zip(StubProcessor.batches[0], [0, 1, 3]):
+            assert (image == frames[frame_index]).all()
+
+        # every frame is published in its own slot's output buffer
+        # the skipped frame is a copy of the previous result
+        for frame_index, frame in enumerate(frames):
+            buffer = processed_frames.wait(frame_index, timeout=0)
+            assert buffer == FrameRing.buffer(frame_index, OUTPUT)
+            assert (
+                frame_ring.array(buffer) == np.repeat(np.repeat(frame, 2, 0), 2, 1)
+            ).all()
+    finally:
+        frame_ring.close()
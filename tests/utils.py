@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from pathlib import Path
+
+import numpy as np
 from PIL import Image, ImageChops, ImageStat
 
 
@@ -16,3 +19,115 @@ def get_image_diff(image0: Image.Image, image1: Image.Image) -> float:
     difference_stat = ImageStat.Stat(difference)
     percent_diff = sum(difference_stat.mean) / (len(difference_stat.mean) * 255) * 100
     return percent_diff
+
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    encoded = bytearray()
+    while True:
+        byte, value = value & 0x7F, value >> 7
+        if value == 0:
+            encoded.append(byte)
+            return bytes(encoded)
+        encoded.append(byte | 0x80)
+
+
+def _field(number: int, value) -> bytes:
+    """
+    encode a protobuf field, integers as varints and bytes as length-delimited
+    """
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _shape(dimensions) -> bytes:
+    return b"".join(_field(2, _field(1, d)) for d in dimensions)
+
+
+def _node(name: str, op: str, inputs: list = [], **attributes) -> bytes:
+    return _field(
+        1,
+        _field(1, name)
+        + _field(2, op)
+        + b"".join(_field(3, i) for i in inputs)
+        + b"".join(
+            _field(5, _field(1, key) + _field(2, value))
+            for key, value in attributes.items()
+        ),
+    )
+
+
+def _const(name: str, array: np.ndarray) -> bytes:
+    # DT_FLOAT is 1 and DT_INT32 is 3
+    data_type = 3 if array.dtype == np.int32 else 1
+    tensor = (
+        _field(1, data_type) + _field(2, _shape(array.shape)) + _field(4, array.tobytes())
+    )
+    return _node(name, "Const", dtype=_field(6, data_type), value=_field(8, tensor))
+
+
+def write_superres_model(path: Path, channels: int, scale: int) -> None:
+    """
+    write a small TensorFlow super resolution model without TensorFlow
+
+    the model applies a 3x3 convolution followed by a transposed convolution
+    with randomized weights close to nearest neighbor upscaling
+
+    :param path Path: path of the .pb file to write
+    :param channels int: number of input and output channels
+    :param scale int: scaling ratio of the model
+    """
+    random = np.random.default_rng(channels)
+    weights = random.normal(0, 0.02, (3, 3, channels, channels)).astype(np.float32)
+    weights[1, 1] += np.eye(channels, dtype=np.float32)
+    biases = random.normal(0, 0.01, channels).astype(np.float32)
+    deconvolution_weights = random.normal(
+        0, 0.02, (scale, scale, channels, channels)
+    ).astype(np.float32)
+    deconvolution_weights += np.eye(channels, dtype=np.float32)
+
+    data_type = _field(6, 1)
+    data_format = _field(2, "NHWC")
+    path.write_bytes(
+        _node(
+            "input",
+            "Placeholder",
+            dtype=data_type,
+            shape=_field(7, _shape([-1, -1, -1, channels])),
+        )
+        + _const("conv/weights", weights)
+        + _node(
+            "conv",
+            "Conv2D",
+            ["input", "conv/weights"],
+            T=data_type,
+            strides=_field(1, _field(3, b"".join(_varint(1) for _ in range(4)))),
+            padding=_field(2, "SAME"),
+            data_format=data_format,
+        )
+        + _const("conv/biases", biases)
+        + _node(
+            "bias",
+            "BiasAdd",
+            ["conv", "conv/biases"],
+            T=data_type,
+            data_format=data_format,
+        )
+        + _const("deconv/shape", np.array([1, scale, scale, channels], np.int32))
+        + _const("deconv/weights", deconvolution_weights)
+        + _node(
+            "output",
+            "Conv2DBackpropInput",
+            ["deconv/shape", "deconv/weights", "bias"],
+            T=data_type,
+            strides=_field(
+                1, _field(3, b"".join(_varint(s) for s in [1, scale, scale, 1]))
+            ),
+            padding=_field(2, "VALID"),
+            data_format=data_format,
+        )
+    )
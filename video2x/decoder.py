@@ -23,12 +23,13 @@ Last Modified: March 21, 2022
 """
 
 import contextlib
+import functools
 import multiprocessing
 import os
 import pathlib
-import queue
 import signal
 import subprocess
+import sys
 import threading
 import time
 from multiprocessing.sharedctypes import Synchronized
@@ -37,8 +38,15 @@ import ffmpeg
 from loguru import logger
 from PIL import Image
 
+from .frame_ring import INPUT, FrameRing
 from .pipe_printer import PipePrinter
 
+# fcntl is only available on POSIX platforms
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # map Loguru log levels to FFmpeg log levels
 LOGURU_FFMPEG_LOGLEVELS = {
     "trace": "trace",
@@ -50,6 +58,13 @@ LOGURU_FFMPEG_LOGLEVELS = {
     "critical": "fatal",
 }
 
+# size of the userspace and kernel buffers of the FFmpeg frame pipe
+PIPE_BUFFER_SIZE = 1 << 20
+
+# fcntl command to resize a pipe's kernel buffer on Linux
+# fcntl.F_SETPIPE_SZ is only defined since Python 3.10
+F_SETPIPE_SZ = 1031
+
 
 class VideoDecoder(threading.Thread):
     def __init__(
@@ -59,10 +74,13 @@ class VideoDecoder(threading.Thread):
         input_height: int,
         frame_rate: float,
         processing_queue: multiprocessing.Queue,
+        frame_ring: FrameRing,
         processing_settings: tuple,
         pause: Synchronized,
         deinterlace=False,
         ignore_max_image_pixels=True,
+        decoder_threads: int = 0,
+        hwaccel: str = None,
     ) -> None:
         threading.Thread.__init__(self)
         self.running = False
@@ -70,6 +88,7 @@ class VideoDecoder(threading.Thread):
         self.input_width = input_width
         self.input_height = input_height
         self.processing_queue = processing_queue
+        self.frame_ring = frame_ring
         self.processing_settings = processing_settings
         self.pause = pause
 
@@ -78,13 +97,43 @@ class VideoDecoder(threading.Thread):
             Image.MAX_IMAGE_PIXELS = None
 
         self.exception = None
-        pipeline = ffmpeg.input(input_path, r=frame_rate)["v"]
+
+        # let FFmpeg decode with frame and slice threading
+        # 0 threads lets FFmpeg pick a thread count matching the CPU
+        # a deep thread queue keeps the demuxer from blocking at high frame rates
+        input_options = dict(
+            r=frame_rate,
+            threads=decoder_threads,
+            thread_type="frame+slice",
+            thread_queue_size=4096,
+        )
+
+        # decode on the GPU's hardware decoder if requested
+        # FFmpeg falls back to software decoding for unsupported codecs
+        if hwaccel is not None:
+            input_options.update(hwaccel=hwaccel)
+
+        pipeline = ffmpeg.input(input_path, **input_options)["v"]
         if deinterlace :
             pipeline = pipeline.filter('yadif')
+
+        # OpenCV converts NV12 to RGB with the BT.601 limited range matrix
+        # convert from the stream's own matrix and range to that one
+        # so that HD and full range sources keep their colors
+        if frame_ring.input_format == "nv12":
+            pipeline = pipeline.filter(
+                "scale", out_color_matrix="bt601", out_range="tv"
+            ).filter("format", "nv12")
+
         self.decoder = subprocess.Popen(
             ffmpeg.compile(
                 pipeline                
-                .output("pipe:1", format="rawvideo", pix_fmt="rgb24", vsync="cfr")
+                .output(
+                    "pipe:1",
+                    format="rawvideo",
+                    pix_fmt=frame_ring.input_format,
+                    vsync="cfr",
+                )
                 .global_args("-hide_banner")
                 .global_args("-nostats")
                 .global_args("-nostdin")
@@ -97,24 +146,52 @@ class VideoDecoder(threading.Thread):
                 overwrite_output=True,
             ),
             env=dict(AV_LOG_FORCE_COLOR="TRUE", **os.environ),
+            bufsize=PIPE_BUFFER_SIZE,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
 
+        # enlarge the frame pipe's kernel buffer so each frame takes
+        # fewer reads and writes to pass through
+        if sys.platform == "linux":
+            with contextlib.suppress(OSError):
+                fcntl.fcntl(self.decoder.stdout, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+
         # start the PIPE printer to start printing FFmpeg logs
         self.pipe_printer = PipePrinter(self.decoder.stderr)
         self.pipe_printer.start()
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def hwaccels() -> list:
+        """
+        list the hardware acceleration methods FFmpeg was built with
+
+        :rtype list: names of the methods, e.g. ["vdpau", "cuda"]
+        """
+        try:
+            output = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-hwaccels"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout.decode()
+        except OSError:
+            return []
+
+        # the first line is a header
+        return output.split()[3:]
+
     def run(self) -> None:
         self.running = True
 
         # the index of the frame
         frame_index = 0
 
-        # create placeholder for previous frame
-        # used in interpolate mode
-        previous_image = None
+        # create placeholder for the previous frame's slot
+        # used in interpolate mode and for frame difference calculation
+        previous_slot = None
 
         # continue running until an exception occurs
         # or all frames have been decoded
@@ -126,37 +203,42 @@ class VideoDecoder(threading.Thread):
                 continue
 
             try:
-                buffer = self.decoder.stdout.read(
-                    3 * self.input_width * self.input_height
-                )
+                # wait for a free slot
+                # each slot is referenced by its own frame's processing job
+                # and by the next frame's job, which compares the two frames
+                slot = self.frame_ring.acquire(2)
+
+                # the ring has been stopped
+                if slot is None:
+                    break
+
+                # read the raw frame straight into the slot's shared memory
+                frame = self.frame_ring.array(FrameRing.buffer(slot, INPUT))
+                size = self.decoder.stdout.readinto(memoryview(frame).cast("B"))
 
                 # source depleted (decoding finished)
                 # after the last frame has been decoded
                 # read will return nothing
-                if len(buffer) == 0:
+                if size == 0:
+                    self.frame_ring.release(slot, 2)
+
+                    # no job will compare the last frame against a next one
+                    if previous_slot is not None:
+                        self.frame_ring.release(previous_slot)
+
                     self.stop()
                     continue
 
-                # convert raw bytes into image object
-                image = Image.frombytes(
-                    "RGB", (self.input_width, self.input_height), buffer
+                if size != self.frame_ring.input_size:
+                    raise ValueError("not enough image data")
+
+                # every queued frame holds a slot, so the number of slots
+                # bounds the queue and putting never has to wait
+                self.processing_queue.put(
+                    (frame_index, (previous_slot, slot), self.processing_settings)
                 )
 
-                # keep checking if the running flag is set to False
-                # while waiting to put the next image into the queue
-                while self.running is True:
-                    with contextlib.suppress(queue.Full):
-                        self.processing_queue.put(
-                            (
-                                frame_index,
-                                (previous_image, image),
-                                self.processing_settings,
-                            ),
-                            timeout=0.1,
-                        )
-                        break
-
-                previous_image = image
+                previous_slot = slot
                 frame_index += 1
 
             # most likely "not enough image data"
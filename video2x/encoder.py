@@ -22,20 +22,30 @@ Date Created: June 17, 2021
 Last Modified: March 20, 2022
 """
 
+import contextlib
+import functools
 import os
 import pathlib
 import signal
 import subprocess
+import sys
+import tempfile
 import threading
 import time
-from multiprocessing.managers import ListProxy
 from multiprocessing.sharedctypes import Synchronized
 
 import ffmpeg
 from loguru import logger
 
+from .frame_ring import FrameRing, ProcessedFrames
 from .pipe_printer import PipePrinter
 
+# fcntl is only available on POSIX platforms
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # map Loguru log levels to FFmpeg log levels
 LOGURU_FFMPEG_LOGLEVELS = {
     "trace": "trace",
@@ -47,6 +57,22 @@ LOGURU_FFMPEG_LOGLEVELS = {
     "critical": "fatal",
 }
 
+# size of the userspace and kernel buffers of the FFmpeg frame pipe
+PIPE_BUFFER_SIZE = 1 << 20
+
+# fcntl command to resize a pipe's kernel buffer on Linux
+# fcntl.F_SETPIPE_SZ is only defined since Python 3.10
+F_SETPIPE_SZ = 1031
+
+# default settings of the supported video encoders
+# quality is passed as CRF to libx264 and as CQ to NVENC
+VIDEO_ENCODER_SETTINGS = {
+    "libx264": {"preset": "veryslow", "quality": 17},
+    "libx265": {"preset": "slow", "quality": 20},
+    "h264_nvenc": {"preset": "p5", "quality": 19},
+    "hevc_nvenc": {"preset": "p5", "quality": 19},
+}
+
 
 class VideoEncoder(threading.Thread):
     def __init__(
@@ -57,19 +83,28 @@ class VideoEncoder(threading.Thread):
         output_width: int,
         output_height: int,
         total_frames: int,
-        processed_frames: ListProxy,
+        frame_ring: FrameRing,
+        processed_frames: ProcessedFrames,
         processed: Synchronized,
         pause: Synchronized,
         copy_audio: bool = True,
         copy_subtitle: bool = True,
         copy_data: bool = False,
         copy_attachments: bool = False,
+        vcodec: str = "libx264",
+        preset: str = None,
+        quality: int = None,
     ) -> None:
         threading.Thread.__init__(self)
         self.running = False
         self.input_path = input_path
         self.output_path = output_path
+        self.copy_audio = copy_audio
+        self.copy_subtitle = copy_subtitle
+        self.copy_data = copy_data
+        self.copy_attachments = copy_attachments
         self.total_frames = total_frames
+        self.frame_ring = frame_ring
         self.processed_frames = processed_frames
         self.processed = processed
         self.pause = pause
@@ -77,8 +112,16 @@ class VideoEncoder(threading.Thread):
         # stores exceptions if the thread exits with errors
         self.exception = None
 
-        # create FFmpeg input for the original input video
-        self.original = ffmpeg.input(input_path)
+        # the video stream is encoded into this file first
+        # and muxed with the original file's other streams by finalize
+        # the file is created with a unique name so no user file is overwritten
+        file_descriptor, video_path = tempfile.mkstemp(
+            suffix=output_path.suffix,
+            prefix=f".{output_path.stem}.video.",
+            dir=output_path.parent,
+        )
+        os.close(file_descriptor)
+        self.video_path = pathlib.Path(video_path)
 
         # define frames as input
         frames = ffmpeg.input(
@@ -90,34 +133,37 @@ class VideoEncoder(threading.Thread):
             r=frame_rate,
         )
 
-        # copy additional streams from original file
-        # https://ffmpeg.org/ffmpeg.html#Stream-specifiers-1
-        additional_streams = [
-            # self.original["1:v?"],
-            self.original["a?"] if copy_audio is True else None,
-            self.original["s?"] if copy_subtitle is True else None,
-            self.original["d?"] if copy_data is True else None,
-            self.original["t?"] if copy_attachments is True else None,
-        ]
+        # fill in the encoder's default settings
+        default_settings = VIDEO_ENCODER_SETTINGS[vcodec]
+        if preset is None:
+            preset = default_settings["preset"]
+
+            # FFmpeg builds before 4.3 only have NVENC's old preset names
+            presets = self.presets(vcodec)
+            if preset not in presets and "slow" in presets:
+                preset = "slow"
+        if quality is None:
+            quality = default_settings["quality"]
+
+        # NVENC runs on the GPU's dedicated encoder in constant quality mode
+        if vcodec.endswith("_nvenc"):
+            encoder_settings = {"preset": preset, "rc": "vbr", "cq": quality, "b:v": 0}
 
-        # run FFmpeg and produce final output
+        # software encoders use all CPU cores
+        else:
+            encoder_settings = {"preset": preset, "crf": quality, "threads": 0}
+
+        # run FFmpeg and encode the video stream only
         self.encoder = subprocess.Popen(
             ffmpeg.compile(
                 ffmpeg.output(
                     frames,
-                    *[s for s in additional_streams if s is not None],
-                    str(self.output_path),
-                    vcodec="libx264",
-                    scodec="copy",
+                    str(self.video_path),
+                    vcodec=vcodec,
                     vsync="cfr",
                     pix_fmt="yuv420p",
-                    crf=17,
-                    preset="veryslow",
-                    # acodec="libfdk_aac",
-                    # cutoff=20000,
+                    **encoder_settings,
                     r=frame_rate,
-                    map_metadata=1,
-                    metadata="comment=Processed with Video2X",
                 )
                 .global_args("-hide_banner")
                 .global_args("-nostats")
@@ -130,14 +176,84 @@ class VideoEncoder(threading.Thread):
                 overwrite_output=True,
             ),
             env=dict(AV_LOG_FORCE_COLOR="TRUE", **os.environ),
+            bufsize=PIPE_BUFFER_SIZE,
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
 
+        # enlarge the frame pipe's kernel buffer so each frame takes
+        # fewer reads and writes to pass through
+        if sys.platform == "linux":
+            with contextlib.suppress(OSError):
+                fcntl.fcntl(self.encoder.stdin, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+
         # start the PIPE printer to start printing FFmpeg logs
         self.pipe_printer = PipePrinter(self.encoder.stderr)
         self.pipe_printer.start()
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def encoders() -> list:
+        """
+        list the video encoders FFmpeg was built with
+
+        :rtype list: names of the encoders, e.g. ["libx264", "h264_nvenc"]
+        """
+        try:
+            output = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-encoders"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout.decode()
+        except OSError:
+            return []
+
+        # the encoders are listed after the legend as " V..... name description"
+        lines = output.splitlines()
+        for index, line in enumerate(lines):
+            if line.strip().startswith("------"):
+                lines = lines[index + 1 :]
+                break
+        return [
+            line.split()[1]
+            for line in lines
+            if len(line.split()) > 1 and line.split()[0].startswith("V")
+        ]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def presets(vcodec: str) -> list:
+        """
+        list the presets an FFmpeg encoder accepts
+
+        :param vcodec str: name of the encoder
+        :rtype list: names of the presets, empty if they are not enumerated
+        """
+        try:
+            output = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-h", f"encoder={vcodec}"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout.decode()
+        except OSError:
+            return []
+
+        # the preset values are indented below the -preset option
+        presets = []
+        indentation = None
+        for line in output.splitlines():
+            words = line.split()
+            if indentation is None:
+                if len(words) > 0 and words[0] == "-preset":
+                    indentation = len(line) - len(line.lstrip())
+                continue
+            if len(words) == 0 or len(line) - len(line.lstrip()) <= indentation:
+                break
+            presets.append(words[0])
+        return presets
+
     def run(self) -> None:
         self.running = True
         frame_index = 0
@@ -149,16 +265,20 @@ class VideoEncoder(threading.Thread):
                 continue
 
             try:
-                image = self.processed_frames[frame_index]
-                if image is None:
-                    time.sleep(0.1)
-                    continue
+                # wait for the frame to be processed
+                # the wait only fails if processing has been stopped
+                buffer = self.processed_frames.wait(frame_index)
+                if buffer == -1:
+                    break
 
-                # send the image to FFmpeg for encoding
-                self.encoder.stdin.write(image.tobytes())
+                # send the frame to FFmpeg for encoding
+                # straight from the shared memory without copying it
+                self.encoder.stdin.write(
+                    memoryview(self.frame_ring.array(buffer)).cast("B")
+                )
 
-                # remove the image from memory
-                self.processed_frames[frame_index] = None
+                # return the frame's slot to the ring
+                self.frame_ring.release(FrameRing.slot(buffer))
 
                 with self.processed.get_lock():
                     self.processed.value += 1
@@ -201,3 +321,74 @@ class VideoEncoder(threading.Thread):
 
     def stop(self) -> None:
         self.running = False
+
+    def finalize(self) -> None:
+        """
+        mux the encoded video stream with the original file's other streams
+        call after the encoder thread has exited
+
+        :raises RuntimeError: raised when FFmpeg fails to mux the streams
+        """
+        logger.info("Muxing video stream with original streams")
+        video = ffmpeg.input(str(self.video_path))
+        original = ffmpeg.input(self.input_path)
+
+        # copy additional streams from original file
+        # https://ffmpeg.org/ffmpeg.html#Stream-specifiers-1
+        additional_streams = [
+            original["a?"] if self.copy_audio is True else None,
+            original["s?"] if self.copy_subtitle is True else None,
+            original["d?"] if self.copy_data is True else None,
+            original["t?"] if self.copy_attachments is True else None,
+        ]
+
+        # the video and subtitle streams are copied
+        # audio is encoded with the output container's default codec
+        # since the container may not be able to hold the original codec
+        muxer = subprocess.Popen(
+            ffmpeg.compile(
+                ffmpeg.output(
+                    video["v"],
+                    *[s for s in additional_streams if s is not None],
+                    str(self.output_path),
+                    vcodec="copy",
+                    scodec="copy",
+                    map_metadata=1,
+                    metadata="comment=Processed with Video2X",
+                )
+                .global_args("-hide_banner")
+                .global_args("-nostats")
+                .global_args("-nostdin")
+                .global_args(
+                    "-loglevel",
+                    LOGURU_FFMPEG_LOGLEVELS.get(
+                        os.environ.get("LOGURU_LEVEL", "INFO").lower()
+                    ),
+                ),
+                overwrite_output=True,
+            ),
+            env=dict(AV_LOG_FORCE_COLOR="TRUE", **os.environ),
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+        # print FFmpeg logs until the muxer exits
+        pipe_printer = PipePrinter(muxer.stderr)
+        pipe_printer.start()
+        try:
+            muxer.wait()
+        finally:
+            pipe_printer.stop()
+            pipe_printer.join()
+            muxer.stderr.close()
+
+        # keep the encoded video stream if muxing failed
+        # so that it can be muxed by hand
+        if muxer.returncode != 0:
+            logger.error(f"The encoded video stream has been kept at {self.video_path}")
+            raise RuntimeError(
+                f"FFmpeg failed to mux {self.video_path} with {self.input_path}"
+            )
+
+        # the video stream is now part of the output file
+        self.video_path.unlink()
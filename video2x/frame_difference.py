@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2018-2022 K4YT3X and contributors.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Name: Frame Difference
+Author: K4YT3X
+Date Created: October 15, 2026
+Last Modified: October 15, 2026
+"""
+
+import numpy as np
+
+# if Numba can be loaded, compile the difference calculation
+# into a fused parallel loop without temporary arrays
+try:
+    import numba
+except ImportError:
+    ENABLE_NUMBA = False
+else:
+    ENABLE_NUMBA = True
+
+
+def _get_difference_ratios_numpy(
+    images0: np.ndarray, images1: np.ndarray
+) -> np.ndarray:
+    """
+    calculate the percent differences between pairs of frames
+
+    :param images0 np.ndarray: NxHxWxC uint8 frames
+    :param images1 np.ndarray: NxHxWxC uint8 frames to compare against
+    :rtype np.ndarray: percent difference of each pair of frames
+    """
+    difference = np.abs(images1.astype(np.int16) - images0)
+    return difference.mean(axis=(1, 2, 3)) / 255 * 100
+
+
+if ENABLE_NUMBA is True:
+
+    @numba.njit(parallel=True, cache=True)
+    def _get_difference_ratios_numba(
+        images0: np.ndarray, images1: np.ndarray
+    ) -> np.ndarray:
+        """
+        calculate the percent differences between pairs of frames
+        same as _get_difference_ratios_numpy without the temporary arrays
+
+        :param images0 np.ndarray: NxHxWxC uint8 frames
+        :param images1 np.ndarray: NxHxWxC uint8 frames to compare against
+        :rtype np.ndarray: percent difference of each pair of frames
+        """
+        count, height, width, channels = images1.shape
+        ratios = np.empty(count)
+        for i in numba.prange(count):
+            total = 0
+            for y in range(height):
+                for x in range(width):
+                    for c in range(channels):
+                        total += abs(
+                            np.int32(images1[i, y, x, c]) - np.int32(images0[i, y, x, c])
+                        )
+            ratios[i] = total / (height * width * channels * 255) * 100
+        return ratios
+
+    get_difference_ratios = _get_difference_ratios_numba
+
+else:
+    get_difference_ratios = _get_difference_ratios_numpy
+
+
+def set_num_threads(num_threads: int) -> None:
+    """
+    limit the number of threads the difference calculation runs on
+
+    :param num_threads int: maximum number of threads
+    """
+    if ENABLE_NUMBA is True:
+        numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2018-2022 K4YT3X and contributors.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Name: Frame Ring
+Author: K4YT3X
+Date Created: October 15, 2026
+Last Modified: October 15, 2026
+"""
+
+import multiprocessing
+import pathlib
+import shutil
+from multiprocessing.shared_memory import SharedMemory
+
+import cv2
+import numpy as np
+
+# kinds of buffers held by each slot
+INPUT = 0
+OUTPUT = 1
+
+# byte alignment of each buffer, keeps SIMD loads and stores on aligned
+# addresses and buffers off each other's cache lines
+BUFFER_ALIGNMENT = 64
+
+# BT.601 limited range YUV to RGB conversion, offsets in the last column
+# the decoder converts NV12 frames to this matrix and range
+_YUV_TO_RGB = np.array(
+    [
+        [1.164384, 0.0, 1.596027],
+        [1.164384, -0.391762, -0.812968],
+        [1.164384, 2.017232, 0.0],
+    ]
+)
+NV12_TO_RGB = np.hstack(
+    [_YUV_TO_RGB, -_YUV_TO_RGB @ np.array([[16], [128], [128]])]
+).astype(np.float32)
+
+# where shared memory blocks are created on Linux
+# container runtimes limit its size to 64 MB by default
+SHARED_MEMORY_PATH = pathlib.Path("/dev/shm")
+
+
+class FrameRing:
+    """
+    a fixed number of frame slots backed by shared memory
+
+    each slot holds one decoded input frame and one processed output frame,
+    so only slot indices have to travel through the queues between the
+    decoder, the processors and the encoder
+
+    a slot is returned to the free list once its reference count drops to 0
+    """
+
+    def __init__(
+        self,
+        slots: int,
+        input_width: int,
+        input_height: int,
+        output_width: int,
+        output_height: int,
+        input_format: str = "rgb24",
+    ) -> None:
+        assert input_format in ["rgb24", "nv12"], "input_format must be rgb24 or nv12"
+        self.input_format = input_format
+        (
+            self.input_shape,
+            self.output_shape,
+            self.output_offset,
+            self.slot_size,
+        ) = self.get_slot_layout(
+            input_width, input_height, output_width, output_height, input_format
+        )
+        self.input_size = int(np.prod(self.input_shape))
+        self.output_size = int(np.prod(self.output_shape))
+
+        # one shared memory block per slot: [input frame | padding | output frame]
+        self.shared_memory = [
+            SharedMemory(create=True, size=self.slot_size) for _ in range(slots)
+        ]
+
+        # reference counts of each slot, guarded by the array's lock
+        self.references = multiprocessing.Array("i", slots)
+
+        # indices of slots that are ready to be filled
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    @staticmethod
+    def get_slot_layout(
+        input_width: int,
+        input_height: int,
+        output_width: int,
+        output_height: int,
+        input_format: str = "rgb24",
+    ) -> tuple:
+        """
+        calculate the layout of each slot's shared memory block
+
+        :rtype tuple: input frame shape, output frame shape,
+            byte offset of the output frame and slot size in bytes
+        """
+
+        # NV12 frames hold a full resolution luma plane followed by
+        # an interleaved half resolution chroma plane, half the size of RGB
+        if input_format == "nv12":
+            input_shape = (input_height * 3 // 2, input_width)
+        else:
+            input_shape = (input_height, input_width, 3)
+        output_shape = (output_height, output_width, 3)
+
+        # shared memory blocks are page-aligned, so the input frame is aligned
+        # pad the input frame so that the output frame is aligned as well
+        input_size = int(np.prod(input_shape))
+        output_offset = -(-input_size // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+
+        return (
+            input_shape,
+            output_shape,
+            output_offset,
+            output_offset + int(np.prod(output_shape)),
+        )
+
+    @staticmethod
+    def get_available_slots(slot_size: int) -> int:
+        """
+        count the slots that fit into the free shared memory
+
+        writing past the size limit of /dev/shm kills the process with
+        SIGBUS instead of failing the allocation, so check beforehand
+
+        :param slot_size int: size of each slot in bytes
+        :rtype int: number of slots, None if the platform has no /dev/shm
+        """
+        if not SHARED_MEMORY_PATH.is_dir():
+            return None
+        return shutil.disk_usage(SHARED_MEMORY_PATH).free // slot_size
+
+    @staticmethod
+    def buffer(slot: int, kind: int) -> int:
+        """
+        get the index of a slot's buffer
+
+        :param slot int: index of the slot
+        :param kind int: INPUT or OUTPUT
+        :rtype int: buffer index
+        """
+        return slot * 2 + kind
+
+    @staticmethod
+    def slot(buffer: int) -> int:
+        """
+        get the index of the slot a buffer belongs to
+
+        :param buffer int: buffer index returned by FrameRing.buffer
+        :rtype int: index of the slot
+        """
+        return buffer // 2
+
+    def array(self, buffer: int) -> np.ndarray:
+        """
+        get a zero-copy view of a buffer
+
+        :param buffer int: buffer index returned by FrameRing.buffer
+        :rtype np.ndarray: uint8 view into the shared memory, HxWx3 for RGB
+            frames and (H*3/2)xW for NV12 frames
+        """
+        slot, kind = divmod(buffer, 2)
+        if kind == INPUT:
+            return np.ndarray(
+                self.input_shape, dtype=np.uint8, buffer=self.shared_memory[slot].buf
+            )
+        return np.ndarray(
+            self.output_shape,
+            dtype=np.uint8,
+            buffer=self.shared_memory[slot].buf,
+            offset=self.output_offset,
+        )
+
+    def rgb(self, buffer: int) -> np.ndarray:
+        """
+        get a buffer's frame as RGB
+
+        :param buffer int: buffer index returned by FrameRing.buffer
+        :rtype np.ndarray: HxWx3 uint8 array, a zero-copy view for RGB frames
+        """
+        frame = self.array(buffer)
+        if frame.ndim == 2:
+            return self.nv12_to_rgb(frame)
+        return frame
+
+    @staticmethod
+    def nv12_to_rgb(
+        frame: np.ndarray, size: tuple = None, interpolation: int = cv2.INTER_LINEAR
+    ) -> np.ndarray:
+        """
+        convert an NV12 frame to RGB
+
+        unlike cv2.COLOR_YUV2RGB_NV12, the chroma is interpolated
+        instead of repeated for each 2x2 block of pixels
+
+        :param frame np.ndarray: (H*3/2)xW uint8 NV12 frame
+        :param size tuple: (width, height) to resize the frame to
+        :param interpolation int: OpenCV interpolation used for resizing
+        :rtype np.ndarray: HxWx3 uint8 RGB frame
+        """
+        height = len(frame) * 2 // 3
+        luma = frame[:height]
+        chroma = frame[height:].reshape(height // 2, -1, 2)
+        if size is None:
+            size = (luma.shape[1], height)
+        else:
+            luma = cv2.resize(luma, size, interpolation=interpolation)
+        chroma = cv2.resize(chroma, size, interpolation=interpolation)
+        return cv2.transform(cv2.merge([luma, chroma]), NV12_TO_RGB)
+
+    def acquire(self, references: int, timeout: float = None) -> int:
+        """
+        take a free slot off the free list
+
+        :param references int: initial reference count of the slot
+        :param timeout float: seconds to wait for a free slot
+        :raises queue.Empty: raised when no slot is freed before the timeout
+        :rtype int: index of the acquired slot, None if the ring was stopped
+        """
+        slot = self.free_slots.get(timeout=timeout)
+        if slot is None:
+            return None
+        with self.references.get_lock():
+            self.references[slot] = references
+        return slot
+
+    def retain(self, slot: int, references: int = 1) -> None:
+        with self.references.get_lock():
+            self.references[slot] += references
+
+    def release(self, slot: int, references: int = 1) -> None:
+        with self.references.get_lock():
+            self.references[slot] -= references
+            if self.references[slot] == 0:
+                self.free_slots.put(slot)
+
+    def stop(self) -> None:
+        """
+        wake up the thread waiting for a free slot
+        """
+        self.free_slots.put(None)
+
+    def close(self) -> None:
+        """
+        release all shared memory blocks
+        only call this from the process that created the ring
+        """
+        self.free_slots.close()
+        for shared_memory in self.shared_memory:
+            shared_memory.close()
+            shared_memory.unlink()
+
+
+class ProcessedFrames:
+    """
+    buffer indices of the processed frames in output order
+
+    producers publish the buffer holding a processed frame and wake up
+    the processes and threads waiting for it
+
+    setting the stop event through stop wakes up all waiters for good
+    """
+
+    def __init__(
+        self, total_frames: int, stop_event: multiprocessing.Event = None
+    ) -> None:
+        # the condition's lock guards the buffer indices
+        self.buffers = multiprocessing.Array("i", [-1] * total_frames, lock=False)
+        self.condition = multiprocessing.Condition()
+        if stop_event is None:
+            stop_event = multiprocessing.Event()
+        self.stop_event = stop_event
+
+    def publish(self, frame_index: int, buffer: int) -> None:
+        with self.condition:
+            self.buffers[frame_index] = buffer
+            self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify_all()
+
+    def wait(self, frame_index: int, timeout: float = None) -> int:
+        """
+        wait for a frame to be processed
+
+        :param frame_index int: index of the frame in the output
+        :param timeout float: seconds to wait for the frame
+        :rtype int: buffer index of the frame,
+            -1 if the wait timed out or was stopped
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.buffers[frame_index] != -1 or self.stop_event.is_set(),
+                timeout,
+            )
+            return self.buffers[frame_index]
@@ -23,16 +23,19 @@ Last Modified: March 20, 2022
 """
 
 import multiprocessing
-import queue
+import os
 import signal
 import time
-from multiprocessing.managers import ListProxy
 from multiprocessing.sharedctypes import Synchronized
 
+import numpy as np
+import threadpoolctl
 from loguru import logger
-from PIL import ImageChops, ImageStat
+from PIL import Image, ImageChops, ImageStat
 from rife_ncnn_vulkan_python.rife_ncnn_vulkan import Rife
 
+from .frame_ring import INPUT, OUTPUT, FrameRing, ProcessedFrames
+
 ALGORITHM_CLASSES = {"rife": Rife}
 
 
@@ -41,15 +44,27 @@ class Interpolator(multiprocessing.Process):
         self,
         instance_number: int,
         processing_queue: multiprocessing.Queue,
-        processed_frames: ListProxy,
+        frame_ring: FrameRing,
+        processed_frames: ProcessedFrames,
         pause: Synchronized,
+        stop_event: multiprocessing.Event,
+        num_gpus: int = 1,
+        num_threads: int = None,
     ) -> None:
         multiprocessing.Process.__init__(self)
         self.running = False
         self.instance_number = instance_number
         self.processing_queue = processing_queue
+        self.frame_ring = frame_ring
         self.processed_frames = processed_frames
         self.pause = pause
+        self.stop_event = stop_event
+        self.num_gpus = num_gpus
+
+        # number of CPU threads each library may use in this process
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        self.num_threads = num_threads
 
         signal.signal(signal.SIGTERM, self._stop)
 
@@ -58,6 +73,12 @@ class Interpolator(multiprocessing.Process):
         logger.opt(colors=True).info(
             f"Interpolator process <blue>{self.name}</blue> initiating"
         )
+
+        # share the CPU cores between the interpolator processes
+        # RIFE's OpenMP runtime is loaded on import and only reads
+        # OMP_NUM_THREADS then, so limit it through threadpoolctl
+        threadpoolctl.threadpool_limits(self.num_threads)
+
         processor_objects = {}
         while self.running is True:
             try:
@@ -66,21 +87,33 @@ class Interpolator(multiprocessing.Process):
                     time.sleep(0.1)
                     continue
 
-                try:
-                    # get new job from queue
-                    (
-                        frame_index,
-                        (image0, image1),
-                        (difference_threshold, algorithm),
-                    ) = self.processing_queue.get(False)
-                except queue.Empty:
-                    time.sleep(0.1)
+                # get new job from queue
+                # a None is queued for each process to stop it
+                # drop the remaining jobs once processing has been stopped
+                job = self.processing_queue.get()
+                if job is None or self.stop_event.is_set():
+                    break
+                (
+                    frame_index,
+                    (previous_slot, slot),
+                    (difference_threshold, algorithm),
+                ) = job
+
+                # if there is no previous frame, this is the first frame
+                # pass it through to the encoder as it is
+                if previous_slot is None:
+                    self.frame_ring.retain(slot)
+                    self.processed_frames.publish(0, FrameRing.buffer(slot, INPUT))
+                    self.frame_ring.release(slot)
                     continue
 
-                # if image0 is None, image1 is the first frame
-                # skip this round
-                if image0 is None:
-                    continue
+                # wrap the frames in the shared memory slots as images
+                image0 = Image.fromarray(
+                    self.frame_ring.array(FrameRing.buffer(previous_slot, INPUT))
+                )
+                image1 = Image.fromarray(
+                    self.frame_ring.array(FrameRing.buffer(slot, INPUT))
+                )
 
                 difference = ImageChops.difference(image0, image1)
                 difference_stat = ImageStat.Stat(difference)
@@ -96,7 +129,9 @@ class Interpolator(multiprocessing.Process):
                     # create a new object if none are available
                     processor_object = processor_objects.get(algorithm)
                     if processor_object is None:
-                        processor_object = ALGORITHM_CLASSES[algorithm](0)
+                        processor_object = ALGORITHM_CLASSES[algorithm](
+                            self.instance_number % max(self.num_gpus, 1)
+                        )
                         processor_objects[algorithm] = processor_object
                     interpolated_image = processor_object.process(image0, image1)
 
@@ -105,10 +140,22 @@ class Interpolator(multiprocessing.Process):
                 else:
                     interpolated_image = image0
 
-                if frame_index == 1:
-                    self.processed_frames[0] = image0
-                self.processed_frames[frame_index * 2 - 1] = interpolated_image
-                self.processed_frames[frame_index * 2] = image1
+                self.frame_ring.array(FrameRing.buffer(slot, OUTPUT))[...] = np.asarray(
+                    interpolated_image
+                )
+
+                # hand the interpolated and the current frame over to the encoder
+                self.frame_ring.retain(slot, 2)
+                self.processed_frames.publish(
+                    frame_index * 2 - 1, FrameRing.buffer(slot, OUTPUT)
+                )
+                self.processed_frames.publish(
+                    frame_index * 2, FrameRing.buffer(slot, INPUT)
+                )
+
+                # this job no longer needs the input frames
+                self.frame_ring.release(slot)
+                self.frame_ring.release(previous_slot)
 
             # send exceptions into the client connection pipe
             except (SystemExit, KeyboardInterrupt):
@@ -24,7 +24,17 @@ Last Modified: March 20, 2022
 
 import cv2
 import numpy as np
-import PIL
+
+# BGR mean of the DIV2K dataset the EDSR models were trained on
+EDSR_MEAN = (103.1545782, 111.5604246, 114.3562901)
+EDSR_MEAN_PLANES = np.array(EDSR_MEAN, dtype=np.float32).reshape(3, 1, 1)
+
+# OpenCV DNN CUDA targets for each inference precision
+PRECISION_TARGETS = {
+    "fp16": cv2.dnn.DNN_TARGET_CUDA_FP16,
+    "fp32": cv2.dnn.DNN_TARGET_CUDA,
+}
+
 
 class SuperRes:
     def __init__(
@@ -33,6 +43,7 @@ class SuperRes:
         noise: int = -1,
         scale: int = 2,
         model: str = "lapsrn",
+        precision: str = "fp16",
         **kwargs,
     ) -> None:
         self.version = 1.0
@@ -40,20 +51,108 @@ class SuperRes:
         assert noise in range(-1, 4), "noise must be 1-3"
         assert scale in [2, 3, 4, 8], "scale must be 2, 3, 4 or 8"
         assert model in ["edsr", "espcn", "fsrcnn", "lapsrn"], "model must be one of edsr, espcn, fsrcnn or lapsrn"
-        
-        self.sr = cv2.dnn_superres.DnnSuperResImpl_create()
-        self.sr.readModel("video2x/models/{m}_x{s}.pb".format(m=model,s=scale))
-        self.sr.setModel(model, scale)
-        self.sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        self.sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-        
-    def process(self, image: PIL.Image) -> PIL.Image:
-        # Convert from PIL to OpenCV
-        cv2_image = np.array(image)
-        cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_RGB2BGR)
-        
-        result = self.sr.upsample(cv2_image)
-        
-        # Convert back to PIL
-        result = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
-        return PIL.Image.fromarray(result)
\ No newline at end of file
+        assert precision in PRECISION_TARGETS, "precision must be fp16 or fp32"
+        self.gpuid = gpuid
+        self.model = model
+        self.scale = scale
+
+        # the network's input blob, allocated on the first batch
+        self.blob = None
+
+        # load the network directly instead of through dnn_superres
+        # so that a whole batch of frames can be fed in one forward pass
+        self.net = cv2.dnn.readNetFromTensorflow(
+            "video2x/models/{m}_x{s}.pb".format(m=model, s=scale)
+        )
+
+        # a gpuid of -1 runs the network on the CPU like the ncnn algorithms
+        # so do OpenCV builds without CUDA, e.g. the pip wheels
+        if gpuid == -1 or cv2.cuda.getCudaEnabledDeviceCount() == 0:
+            self.gpuid = -1
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+            return
+
+        # the CUDA backend runs on the current device
+        # this object lives in a single upscaler process, so select it once
+        cv2.cuda.setDevice(gpuid)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+
+        # half precision halves the memory traffic of the small networks
+        # OpenCV falls back to single precision on GPUs without FP16 support
+        self.net.setPreferableTarget(PRECISION_TARGETS[precision])
+
+    def process(self, image: np.ndarray) -> np.ndarray:
+        return self.process_batch([image])[0]
+
+    def process_batch(self, images: list) -> list:
+        """
+        upscale a batch of frames in one forward pass
+
+        :param images list: HxWx3 uint8 RGB arrays of the same size
+        :rtype list: upscaled HxWx3 uint8 RGB arrays
+        """
+
+        height, width = images[0].shape[:2]
+
+        # EDSR works on all three channels in BGR order
+        # with the dataset mean subtracted
+        if self.model == "edsr":
+            blob = self._get_blob(len(images), 3, height, width)
+            for image, planes in zip(images, blob):
+                np.subtract(
+                    image[..., ::-1].transpose(2, 0, 1), EDSR_MEAN_PLANES, out=planes
+                )
+            self.net.setInput(blob)
+            return [
+                np.clip(
+                    np.rint(output[::-1].transpose(1, 2, 0) + EDSR_MEAN[::-1]), 0, 255
+                ).astype(np.uint8)
+                for output in self.net.forward()
+            ]
+
+        # the other models only upscale the normalized luma channel
+        blob = self._get_blob(len(images), 1, height, width)
+        ycrcb_images = []
+        for image, planes in zip(images, blob):
+            ycrcb_image = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
+            np.multiply(ycrcb_image[..., 0], np.float32(1 / 255), out=planes[0])
+            ycrcb_images.append(ycrcb_image)
+        self.net.setInput(blob)
+
+        # chroma channels are upscaled bilinearly and merged back
+        # one by one as normalized floats like dnn_superres, rounded only once
+        results = []
+        for ycrcb_image, output in zip(ycrcb_images, self.net.forward()):
+            result = np.empty((*output.shape[1:], 3), np.float32)
+            result[..., 0] = output[0]
+            for channel in [1, 2]:
+                result[..., channel] = cv2.resize(
+                    ycrcb_image[..., channel].astype(np.float32) * np.float32(1 / 255),
+                    None,
+                    fx=self.scale,
+                    fy=self.scale,
+                )
+            result = np.clip(np.rint(result * 255), 0, 255).astype(np.uint8)
+            results.append(cv2.cvtColor(result, cv2.COLOR_YCrCb2RGB))
+        return results
+
+    def _get_blob(
+        self, batch_size: int, channels: int, height: int, width: int
+    ) -> np.ndarray:
+        """
+        get the network's input blob
+
+        the blob is allocated once and reused for every following batch
+        of frames, it is only reallocated if the frame size changes or a
+        larger batch comes in
+
+        :rtype np.ndarray: NxCxHxW float32 blob
+        """
+        if (
+            self.blob is None
+            or self.blob.shape[1:] != (channels, height, width)
+            or len(self.blob) < batch_size
+        ):
+            self.blob = np.empty((batch_size, channels, height, width), np.float32)
+        return self.blob[:batch_size]
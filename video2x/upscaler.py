@@ -22,6 +22,7 @@ Date Created: May 27, 2021
 Last Modified: March 20, 2022
 """
 
+import functools
 import math
 import multiprocessing
 import os
@@ -29,17 +30,31 @@ import queue
 import signal
 import subprocess
 import time
-from multiprocessing.managers import ListProxy
 from multiprocessing.sharedctypes import Synchronized
 
+import cv2
+import numpy as np
+import threadpoolctl
 from loguru import logger
-from PIL import Image, ImageChops, ImageStat
+from PIL import Image
 from realcugan_ncnn_vulkan_python import Realcugan
 from realsr_ncnn_vulkan_python import Realsr
 from srmd_ncnn_vulkan_python import Srmd
 from waifu2x_ncnn_vulkan_python import Waifu2x
+
+from .frame_difference import get_difference_ratios, set_num_threads
+from .frame_ring import INPUT, OUTPUT, FrameRing, ProcessedFrames
 from .superres import SuperRes
 
+# if pynvml can be loaded, count GPUs through NVML
+# instead of running nvidia-smi
+try:
+    import pynvml
+except ImportError:
+    ENABLE_NVML = False
+else:
+    ENABLE_NVML = True
+
 # fixed scaling ratios supported by the algorithms
 # that only support certain fixed scale ratios
 ALGORITHM_FIXED_SCALING_RATIOS = {
@@ -61,25 +76,48 @@ ALGORITHM_CLASSES = {
     "superres": SuperRes,
 }
 
+# maximum number of frames processed together by each upscaler
+BATCH_SIZE = 4
+
+# size of the thumbnails frame differences are calculated on
+DIFFERENCE_THUMBNAIL_SIZE = (64, 64)
+
 
 class Upscaler(multiprocessing.Process):
     def __init__(
         self,
         instance_number: int,
         processing_queue: multiprocessing.Queue,
-        processed_frames: ListProxy,
+        frame_ring: FrameRing,
+        processed_frames: ProcessedFrames,
         pause: Synchronized,
+        stop_event: multiprocessing.Event,
+        batch_size: int = BATCH_SIZE,
+        precision: str = "fp16",
+        num_gpus: int = None,
+        num_threads: int = None,
     ) -> None:
         multiprocessing.Process.__init__(self)
         self.running = False
         self.instance_number = instance_number
         self.processing_queue = processing_queue
+        self.frame_ring = frame_ring
         self.processed_frames = processed_frames
         self.pause = pause
+        self.stop_event = stop_event
+        self.batch_size = batch_size
+        self.precision = precision
         
-        # Determine the number of GPUs in the system
+        # Determine the number of GPUs in the system unless the caller did
         # This is hard to do cross-vendor/platform - NVidia for now
-        self.num_gpus = self.num_nvidia_gpus()
+        if num_gpus is None:
+            num_gpus = self.num_nvidia_gpus()
+        self.num_gpus = num_gpus
+
+        # number of CPU threads each library may use in this process
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        self.num_threads = num_threads
 
         signal.signal(signal.SIGTERM, self._stop)
 
@@ -88,7 +126,27 @@ class Upscaler(multiprocessing.Process):
         logger.opt(colors=True).info(
             f"Upscaler process <blue>{self.name}</blue> initiating"
         )
+
+        # share the CPU cores between the upscaler processes instead of
+        # letting every library in every process start a thread per core
+        # the OpenMP runtime of the ncnn algorithms is loaded on import
+        # and only reads OMP_NUM_THREADS then, so limit it through threadpoolctl
+        cv2.setNumThreads(self.num_threads)
+        set_num_threads(self.num_threads)
+        threadpoolctl.threadpool_limits(self.num_threads)
+
         processor_objects = {}
+        scaling_plans = {}
+
+        # compile the difference calculation before the first frame arrives
+        get_difference_ratios(
+            np.zeros((1, 1, 1, 3), np.uint8), np.zeros((1, 1, 1, 3), np.uint8)
+        )
+
+        # the thumbnail of the last frame this process has seen
+        # reused when this process also receives the next frame
+        thumbnail_index, thumbnail = None, None
+
         while self.running is True:
             try:
                 # pause if pause flag is set
@@ -96,103 +154,93 @@ class Upscaler(multiprocessing.Process):
                     time.sleep(0.1)
                     continue
 
-                try:
-                    # get new job from queue
-                    (
-                        frame_index,
-                        (image0, image1),
-                        (
-                            output_width,
-                            output_height,
-                            noise,
-                            difference_threshold,
-                            algorithm,
-                        ),
-                    ) = self.processing_queue.get(False)
-
-                    # destructure settings
-                except queue.Empty:
-                    time.sleep(0.1)
-                    continue
-
-                difference_ratio = 0
-                # Don't bother to caclulate the ratio if the threshold is off
-                if image0 is not None and difference_threshold > 0:
-                    difference = ImageChops.difference(image0, image1)
-                    difference_stat = ImageStat.Stat(difference)
-                    difference_ratio = (
-                        sum(difference_stat.mean)
-                        / (len(difference_stat.mean) * 255)
-                        * 100
+                # get new job from queue
+                jobs = [self.processing_queue.get()]
+
+                # gather the frames that are already queued into a batch
+                while len(jobs) < self.batch_size and jobs[-1] is not None:
+                    try:
+                        jobs.append(self.processing_queue.get(False))
+                    except queue.Empty:
+                        break
+
+                # a None is queued for each process to stop it
+                # drop the remaining jobs once processing has been stopped
+                if None in jobs or self.stop_event.is_set():
+                    break
+
+                # destructure settings
+                # settings are identical for all frames of a video
+                (
+                    output_width,
+                    output_height,
+                    noise,
+                    difference_threshold,
+                    algorithm,
+                ) = jobs[0][2]
+
+                # compare small thumbnails of each frame and its previous frame
+                # Don't bother to caclulate the ratios if the threshold is off
+                difference_ratios = np.zeros(len(jobs))
+                if difference_threshold > 0:
+                    thumbnails0 = np.empty(
+                        (len(jobs), *DIFFERENCE_THUMBNAIL_SIZE[::-1], 3), np.uint8
                     )
+                    thumbnails1 = np.empty_like(thumbnails0)
+                    for job, (frame_index, (previous_slot, slot), _) in enumerate(
+                        jobs
+                    ):
+                        self._get_thumbnail(
+                            self.frame_ring.array(FrameRing.buffer(slot, INPUT)),
+                            thumbnails1[job],
+                        )
+                        if previous_slot is None:
+                            thumbnails0[job] = thumbnails1[job]
+                        elif thumbnail_index == frame_index - 1:
+                            thumbnails0[job] = thumbnail
+                        else:
+                            self._get_thumbnail(
+                                self.frame_ring.array(
+                                    FrameRing.buffer(previous_slot, INPUT)
+                                ),
+                                thumbnails0[job],
+                            )
+                        thumbnail_index, thumbnail = frame_index, thumbnails1[job]
+
+                    difference_ratios = get_difference_ratios(thumbnails0, thumbnails1)
+
+                # frames that need to be processed
+                # frames left out are copied from the previous result
+                frame_indices = []
+                images = []
+
+                for (frame_index, (previous_slot, slot), _), difference_ratio in zip(
+                    jobs, difference_ratios
+                ):
+
+                    # if the difference is greater than threshold
+                    # process this frame
+                    if previous_slot is None or difference_ratio >= difference_threshold:
+                        frame_indices.append(frame_index)
+                        images.append(
+                            self.frame_ring.rgb(FrameRing.buffer(slot, INPUT))
+                        )
 
-                # if the difference is lower than threshold
-                # skip this frame
-                if difference_ratio < difference_threshold:
-
-                    # make sure the previous frame has been processed
-                    if frame_index > 0:
-                        while self.processed_frames[frame_index - 1] is None:
-                            time.sleep(0.1)
-
-                    # make the current image the same as the previous result
-                    self.processed_frames[frame_index] = self.processed_frames[
-                        frame_index - 1
-                    ]
-
-                # if the difference is greater than threshold
-                # process this frame
-                else:
-                    width, height = image1.size
+                if len(images) > 0:
+                    height, width = images[0].shape[:2]
 
-                    # calculate required minimum scale ratio
-                    output_scale = max(output_width / width, output_height / height)
+                    # the scaling jobs only depend on the frame size and the
+                    # settings, so they are only planned once per video
+                    plan = (width, height, output_width, output_height, algorithm)
+                    scaling_jobs = scaling_plans.get(plan)
+                    if scaling_jobs is None:
+                        scaling_jobs = self._get_scaling_tasks(*plan)
+                        scaling_plans[plan] = scaling_jobs
 
-                    # select the optimal algorithm scaling ratio to use
                     # split out the model parameter if the algorithm is SuperRes
                     algo_model = None
                     if algorithm.startswith("superres"):
                         algorithm, algo_model = algorithm.split("-", 2)
-                        supported_scaling_ratios = sorted(
-                            ALGORITHM_FIXED_SCALING_RATIOS[algo_model]
-                        )
-                    else:
-                        supported_scaling_ratios = sorted(
-                            ALGORITHM_FIXED_SCALING_RATIOS[algorithm]
-                        )
-
-                    remaining_scaling_ratio = math.ceil(output_scale)
-                    scaling_jobs = []
-
-                    # if the scaling ratio is 1.0
-                    # apply the smallest scaling ratio available
-                    if remaining_scaling_ratio == 1:
-                        scaling_jobs.append(supported_scaling_ratios[0])
-                    else:
-                        while remaining_scaling_ratio > 1:
-                            for ratio in supported_scaling_ratios:
-                                if ratio >= remaining_scaling_ratio:
-                                    scaling_jobs.append(ratio)
-                                    remaining_scaling_ratio /= ratio
-                                    break
-
-                            else:
-                                found = False
-                                for i in supported_scaling_ratios:
-                                    for j in supported_scaling_ratios:
-                                        if i * j >= remaining_scaling_ratio:
-                                            scaling_jobs.extend([i, j])
-                                            remaining_scaling_ratio /= i * j
-                                            found = True
-                                            break
-                                    if found is True:
-                                        break
-
-                                if found is False:
-                                    scaling_jobs.append(supported_scaling_ratios[-1])
-                                    remaining_scaling_ratio /= supported_scaling_ratios[
-                                        -1
-                                    ]
 
                     for job in scaling_jobs:
 
@@ -200,20 +248,74 @@ class Upscaler(multiprocessing.Process):
                         # create a new object if none are available
                         processor_object = processor_objects.get((algorithm, job))
                         if processor_object is None:
-                            gpuid = self.instance_number % self.num_gpus
+                            gpuid = self.instance_number % max(self.num_gpus, 1)
                             algo_params = dict (gpuid=gpuid, noise=noise, scale=job)
                             if algorithm == "superres":
-                                algo_params.update(model=algo_model)
+                                algo_params.update(
+                                    model=algo_model, precision=self.precision
+                                )
                             processor_object = ALGORITHM_CLASSES[algorithm](**algo_params)
                             processor_objects[(algorithm, job)] = processor_object
 
-                        # process the image with the selected algorithm
-                        image1 = processor_object.process(image1)
+                        # process the images with the selected algorithm
+                        # in one pass on arrays if the algorithm supports batches
+                        # only convert to PIL images for the other algorithms
+                        if hasattr(processor_object, "process_batch"):
+                            images = processor_object.process_batch(
+                                [np.asarray(i) for i in images]
+                            )
+                        else:
+                            images = [
+                                processor_object.process(
+                                    Image.fromarray(i)
+                                    if isinstance(i, np.ndarray)
+                                    else i
+                                )
+                                for i in images
+                            ]
+
+                # processed images keyed by their frame indices
+                processed_images = dict(zip(frame_indices, images))
+
+                # hand the frames over to the encoder in order
+                # so that skipped frames can wait for the frames before them
+                for frame_index, (previous_slot, slot), _ in jobs:
+                    output = self.frame_ring.array(FrameRing.buffer(slot, OUTPUT))
+
+                    # if the difference is lower than threshold
+                    # skip this frame
+                    if frame_index not in processed_images:
+
+                        # make sure the previous frame has been processed
+                        # the wait only fails if processing has been stopped
+                        if self.processed_frames.wait(frame_index - 1) == -1:
+                            break
+
+                        # make the current image the same as the previous result
+                        output[...] = self.frame_ring.array(
+                            FrameRing.buffer(previous_slot, OUTPUT)
+                        )
+
+                    # downscale the image to the desired output size
+                    # straight into the slot
+                    else:
+                        cv2.resize(
+                            np.asarray(processed_images[frame_index]),
+                            (output_width, output_height),
+                            dst=output,
+                            interpolation=cv2.INTER_AREA,
+                        )
+
+                    # hand the processed frame over to the encoder
+                    self.frame_ring.retain(slot)
+                    self.processed_frames.publish(
+                        frame_index, FrameRing.buffer(slot, OUTPUT)
+                    )
 
-                    # downscale the image to the desired output size and
-                    # save the image to disk
-                    image1 = image1.resize((output_width, output_height), Image.LANCZOS)
-                    self.processed_frames[frame_index] = image1
+                    # this job no longer needs the input frames
+                    self.frame_ring.release(slot)
+                    if previous_slot is not None:
+                        self.frame_ring.release(previous_slot)
 
             # send exceptions into the client connection pipe
             except (SystemExit, KeyboardInterrupt):
@@ -228,10 +330,110 @@ class Upscaler(multiprocessing.Process):
         )
         return super().run()
 
+    @staticmethod
+    def _get_scaling_tasks(
+        input_width: int,
+        input_height: int,
+        output_width: int,
+        output_height: int,
+        algorithm: str,
+    ) -> list:
+        """
+        plan the scaling ratios to apply to reach the output size
+
+        :param input_width int: width of the input frames
+        :param input_height int: height of the input frames
+        :param output_width int: width of the output frames
+        :param output_height int: height of the output frames
+        :param algorithm str: the algorithm, e.g. "waifu2x" or "superres-edsr"
+        :rtype list: scaling ratios to apply one after another
+        """
+
+        # calculate required minimum scale ratio
+        output_scale = max(output_width / input_width, output_height / input_height)
+
+        # select the optimal algorithm scaling ratio to use
+        # SuperRes algorithms are named after their models
+        if algorithm.startswith("superres"):
+            algorithm = algorithm.split("-", 2)[1]
+        supported_scaling_ratios = sorted(ALGORITHM_FIXED_SCALING_RATIOS[algorithm])
+
+        remaining_scaling_ratio = math.ceil(output_scale)
+        scaling_jobs = []
+
+        # if the scaling ratio is 1.0
+        # apply the smallest scaling ratio available
+        if remaining_scaling_ratio == 1:
+            scaling_jobs.append(supported_scaling_ratios[0])
+        else:
+            while remaining_scaling_ratio > 1:
+                for ratio in supported_scaling_ratios:
+                    if ratio >= remaining_scaling_ratio:
+                        scaling_jobs.append(ratio)
+                        remaining_scaling_ratio /= ratio
+                        break
+
+                else:
+                    found = False
+                    for i in supported_scaling_ratios:
+                        for j in supported_scaling_ratios:
+                            if i * j >= remaining_scaling_ratio:
+                                scaling_jobs.extend([i, j])
+                                remaining_scaling_ratio /= i * j
+                                found = True
+                                break
+                        if found is True:
+                            break
+
+                    if found is False:
+                        scaling_jobs.append(supported_scaling_ratios[-1])
+                        remaining_scaling_ratio /= supported_scaling_ratios[-1]
+
+        return scaling_jobs
+
+    @staticmethod
+    def _get_thumbnail(image: np.ndarray, thumbnail: np.ndarray) -> None:
+        """
+        downsample a frame for calculating frame differences
+
+        :param image np.ndarray: the frame to downsample
+        :param thumbnail np.ndarray: the array to write the thumbnail into
+        """
+
+        # NV12 frames are downsampled before they are converted to RGB
+        # so that the thresholds mean the same for RGB and NV12 frames
+        if image.ndim == 2:
+            thumbnail[...] = FrameRing.nv12_to_rgb(
+                image, DIFFERENCE_THUMBNAIL_SIZE, cv2.INTER_AREA
+            )
+            return
+
+        cv2.resize(
+            image, DIFFERENCE_THUMBNAIL_SIZE, dst=thumbnail, interpolation=cv2.INTER_AREA
+        )
+
     def _stop(self, _signal_number, _frame) -> None:
         self.running = False
     
-    def num_nvidia_gpus(self) -> int:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def num_nvidia_gpus() -> int:
+        """
+        count the NVIDIA GPUs in the system
+        the result is cached, so GPUs are only counted once per process
+
+        :rtype int: number of NVIDIA GPUs, 0 if none are found
+        """
+        if ENABLE_NVML is True:
+            try:
+                pynvml.nvmlInit()
+                try:
+                    return pynvml.nvmlDeviceGetCount()
+                finally:
+                    pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                return 0
+
         try:
             p = subprocess.Popen(["nvidia-smi","--list-gpus"], stdout=subprocess.PIPE)
             stdout, stderror = p.communicate()
@@ -68,9 +68,10 @@ from rich.text import Text
 
 from . import __version__
 from .decoder import VideoDecoder
-from .encoder import VideoEncoder
+from .encoder import VIDEO_ENCODER_SETTINGS, VideoEncoder
+from .frame_ring import FrameRing, ProcessedFrames
 from .interpolator import Interpolator
-from .upscaler import Upscaler
+from .upscaler import BATCH_SIZE, Upscaler
 
 # for desktop environments only
 # if pynput can be loaded, enable global pause hotkey support
@@ -196,6 +197,8 @@ class Video2X:
         processes: int,
         processing_settings: tuple,
         deinterlace=False,
+        vcodec: str = None,
+        processor_options: dict = None,
     ) -> None:
 
         # record original STDOUT and STDERR for restoration
@@ -214,9 +217,67 @@ class Video2X:
         logger.add(sys.stderr, colorize=True, format=LOGURU_FORMAT)
 
         # initialize values
+        if processor_options is None:
+            processor_options = {}
         self.processor_processes = []
-        self.processing_queue = multiprocessing.Queue(maxsize=processes * 10)
-        processed_frames = multiprocessing.Manager().list([None] * total_frames)
+        # the queue is bounded by the number of frame slots
+        self.processing_queue = multiprocessing.Queue()
+
+        # count the GPUs once for the decoder, the encoder and all processes
+        num_gpus = Upscaler.num_nvidia_gpus()
+
+        # decode on NVDEC and pass the smaller NV12 frames through the pipe
+        # interpolation hands decoded frames to the encoder, so it needs RGB
+        # NV12 needs an even frame size
+        hwaccel = None
+        input_format = "rgb24"
+        if (
+            mode == "upscale"
+            and num_gpus > 0
+            and width % 2 == 0
+            and height % 2 == 0
+            and "cuda" in VideoDecoder.hwaccels()
+        ):
+            hwaccel = "cuda"
+            input_format = "nv12"
+
+        # shared memory slots that frames are decoded into and processed in
+        # enough for each process to hold a full batch and one previous frame
+        # plus two for the frames being decoded and encoded
+        slots = processes * (BATCH_SIZE + 1) + 2
+
+        # use fewer slots if they don't all fit into /dev/shm
+        # processes then work on smaller batches, but 2 slots are needed
+        slot_size = FrameRing.get_slot_layout(
+            width, height, output_width, output_height, input_format
+        )[3]
+        available_slots = FrameRing.get_available_slots(slot_size)
+        if available_slots is not None and available_slots < slots:
+            if available_slots < 2:
+                raise RuntimeError(
+                    f"not enough free shared memory in /dev/shm for 2 frames of"
+                    f" {slot_size} bytes, start containers with a larger --shm-size"
+                )
+            logger.warning(
+                f"Only {available_slots} of {slots} frame slots fit into /dev/shm,"
+                " start containers with a larger --shm-size for better performance"
+            )
+            slots = available_slots
+
+        self.frame_ring = FrameRing(
+            slots,
+            width,
+            height,
+            output_width,
+            output_height,
+            input_format=input_format,
+        )
+
+        # set once to stop every stage of the pipeline
+        self.stop_event = multiprocessing.Event()
+
+        # buffer index of each processed frame
+        self.processed_frames = ProcessedFrames(total_frames, self.stop_event)
         self.processed = multiprocessing.Value("I", 0)
         self.pause = multiprocessing.Value(ctypes.c_bool, False)
 
@@ -228,12 +289,24 @@ class Video2X:
             height,
             frame_rate,
             self.processing_queue,
+            self.frame_ring,
             processing_settings,
             self.pause,
             deinterlace=deinterlace,
+            hwaccel=hwaccel,
         )
         self.decoder.start()
 
+        # encode on the GPU's NVENC encoder unless the user picked an encoder
+        # if an NVIDIA GPU is present and FFmpeg was built with NVENC
+        if vcodec is None:
+            vcodec = (
+                "h264_nvenc"
+                if num_gpus > 0 and "h264_nvenc" in VideoEncoder.encoders()
+                else "libx264"
+            )
+        logger.info(f"Encoding with {vcodec}")
+
         # set up and start encoder thread
         logger.info("Starting video encoder")
         self.encoder = VideoEncoder(
@@ -243,15 +316,27 @@ class Video2X:
             output_width,
             output_height,
             total_frames,
-            processed_frames,
+            self.frame_ring,
+            self.processed_frames,
             self.processed,
             self.pause,
+            vcodec=vcodec,
         )
         self.encoder.start()
 
         # create processor processes
         for process_name in range(processes):
-            process = Processor(process_name, self.processing_queue, processed_frames, self.pause)
+            process = Processor(
+                process_name,
+                self.processing_queue,
+                self.frame_ring,
+                self.processed_frames,
+                self.pause,
+                self.stop_event,
+                num_gpus=num_gpus,
+                num_threads=max((os.cpu_count() or 1) // processes, 1),
+                **processor_options,
+            )
             process.name = str(process_name)
             process.daemon = True
             process.start()
@@ -358,29 +443,60 @@ class Video2X:
             # stop progress display
             self.progress.stop()
 
-            # stop processor processes
-            logger.info("Stopping processor processes")
-            for process in self.processor_processes:
-                process.terminate()
-
-            # wait for processes to finish
-            for process in self.processor_processes:
-                process.join()
+            # on success, let the pipeline drain
+            # the decoder exits once it has queued the last frame
+            # and the processes once they reach their None in the queue
+            if len(exception) == 0:
+                logger.info("Waiting for the remaining frames")
+                self.decoder.join()
+                for _ in self.processor_processes:
+                    self.processing_queue.put(None)
+                for process in self.processor_processes:
+                    process.join()
+
+                # every frame has been published now
+                # wake up the encoder in case the video has fewer frames
+                # than it reported, it still writes all published frames
+                self.processed_frames.stop()
+                self.encoder.join()
+
+            # otherwise stop processor processes
+            # wake up the processes waiting for frames and queue a None
+            # for each process waiting for a job
+            else:
+                logger.info("Stopping processor processes")
+                self.processed_frames.stop()
+                for _ in self.processor_processes:
+                    self.processing_queue.put(None)
+
+                # wait for processes to finish
+                for process in self.processor_processes:
+                    process.join()
 
-            # stop encoder and decoder
-            logger.info("Stopping decoder and encoder threads")
-            self.decoder.stop()
-            self.encoder.stop()
-            self.decoder.join()
-            self.encoder.join()
+                # stop encoder and decoder
+                # wake up the decoder if it is waiting for a free slot
+                logger.info("Stopping decoder and encoder threads")
+                self.frame_ring.stop()
+                self.decoder.stop()
+                self.encoder.stop()
+                self.decoder.join()
+                self.encoder.join()
 
             # mark processing queue as closed
             self.processing_queue.close()
 
+            # release the shared memory frame slots
+            self.frame_ring.close()
+
             # raise the error if there is any
+            # and remove the incomplete video stream
             if len(exception) > 0:
+                self.encoder.video_path.unlink(missing_ok=True)
                 raise exception[0]
 
+            # add the original audio, subtitle and other streams to the output
+            self.encoder.finalize()
+
             # restore original STDOUT and STDERR
             sys.stdout = original_stdout
             sys.stderr = original_stderr
@@ -399,7 +515,9 @@ class Video2X:
         processes: int,
         threshold: float,
         algorithm: str,
-        deinterlace=False
+        deinterlace=False,
+        vcodec: str = None,
+        precision: str = "fp16",
     ) -> None:
 
         # get basic video information
@@ -437,6 +555,8 @@ class Video2X:
                 algorithm,
             ),
             deinterlace=deinterlace,
+            vcodec=vcodec,
+            processor_options={"precision": precision},
         )
 
     def interpolate(
@@ -446,6 +566,7 @@ class Video2X:
         processes: int,
         threshold: float,
         algorithm: str,
+        vcodec: str = None,
     ) -> None:
 
         # get video basic information
@@ -468,6 +589,7 @@ class Video2X:
             "interpolate",
             processes,
             (threshold, algorithm),
+            vcodec=vcodec,
         )
 
 
@@ -501,6 +623,15 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument(
         "-p", "--processes", type=int, help="number of processes to launch", default=1
     )
+    parser.add_argument(
+        "-c",
+        "--codec",
+        choices=VIDEO_ENCODER_SETTINGS.keys(),
+        help=(
+            "video encoder to use; defaults to h264_nvenc if an NVIDIA GPU"
+            " is present and FFmpeg supports it, otherwise libx264"
+        ),
+    )
     parser.add_argument(
         "-l",
         "--loglevel",
@@ -533,6 +664,12 @@ def parse_arguments() -> argparse.Namespace:
         help="algorithm to use for upscaling",
         default=UPSCALING_ALGORITHMS[0],
     )
+    upscale.add_argument(
+        "--precision",
+        choices=["fp16", "fp32"],
+        help="inference precision of the superres algorithms on NVIDIA GPUs",
+        default="fp16",
+    )
     upscale.add_argument(
         "-t",
         "--threshold",
@@ -632,6 +769,8 @@ def main() -> int:
                 args.threshold,
                 args.algorithm,
                 args.deinterlace,
+                args.codec,
+                args.precision,
             )
 
         elif args.action == "interpolate":
@@ -641,6 +780,7 @@ def main() -> int:
                 args.processes,
                 args.threshold,
                 args.algorithm,
+                args.codec,
             )
 
     # don't print the traceback for manual terminations